@@ -3,6 +3,7 @@ from prefect.cache_policies import NO_CACHE
 from prefect.task_runners import ConcurrentTaskRunner
 from prefect.blocks.notifications import SlackWebhook
 from datetime import timedelta
+from typing import Optional
 import traceback
 from recommend import recommendation_v1 as rec
 
@@ -21,6 +22,8 @@ def task_load_env():
     try:
         env = rec.load_env_variables()
         logger.info("Environment variables loaded successfully")
+        rec.init_pool(env)
+        logger.info("Database connection pool initialized")
         return env
     except Exception as e:
         logger.error("Failed to load environment: %s", str(e))
@@ -28,71 +31,75 @@ def task_load_env():
 
 
 @task(
-    name="Fetch Data from Database",
+    name="Fetch Restaurants from Database",
     retries=3,
     retry_delay_seconds=10
 )
-def task_fetch_data(env):
+def task_fetch_restaurants(env):
     logger = get_run_logger()
-    logger.info("Connecting to database and fetching data...")
+    logger.info("Connecting to database and fetching restaurants...")
     
     try:
-        con, cursor = rec.connect_db(env)
-        logger.info("Database connection established")
-        
-        df_restaurants, df_users = rec.fetch_datas(cursor)
-        con.close()
+        with rec.db_conn(env) as con:
+            logger.info("Database connection established")
+            df_restaurants = rec.fetch_restaurants(con)
         
         # Validation checks
-        if df_restaurants.empty or df_users.empty:
-            raise ValueError("Empty dataset retrieved from database")
+        if df_restaurants.empty:
+            raise ValueError("Empty restaurant dataset retrieved from database")
         
-        logger.info("Fetched %d restaurants and %d users", len(df_restaurants), len(df_users))
+        logger.info("Fetched %d restaurants", len(df_restaurants))
         logger.info("Restaurant columns: %s", list(df_restaurants.columns))
-        logger.info("User columns: %s", list(df_users.columns))
         
-        return df_restaurants, df_users
+        return df_restaurants
         
     except Exception as e:
-        logger.error("Failed to fetch data: %s", str(e))
+        logger.error("Failed to fetch restaurants: %s", str(e))
         logger.error("Traceback: %s", traceback.format_exc())
         raise
 
 
 @task(
-    name="Preprocess Data"
+    name="Fetch Users from Database",
+    retries=3,
+    retry_delay_seconds=10
 )
-def task_preprocess(df_restaurants, df_users):
+def task_fetch_users(env):
     logger = get_run_logger()
-    logger.info("Preprocessing data...")
+    logger.info("Connecting to database and fetching users...")
     
     try:
-        restaurant_profiles, user_profiles = rec.preprocess_data(df_restaurants, df_users)
+        with rec.db_conn(env) as con:
+            logger.info("Database connection established")
+            df_users = rec.fetch_users(con)
         
-        # Validation
-        if restaurant_profiles.empty or user_profiles.empty:
-            raise ValueError("Preprocessing resulted in empty profiles")
+        # Validation checks
+        if df_users.empty:
+            raise ValueError("Empty user dataset retrieved from database")
         
-        logger.info("Created %d restaurant profiles and %d user profiles", len(restaurant_profiles), len(user_profiles))
-        logger.info("Avg tags per restaurant: %.2f", df_restaurants.groupby('restaurant_id').size().mean())
-        logger.info("Avg tags per user: %.2f", df_users.groupby('user_id').size().mean())
+        logger.info("Fetched %d users", len(df_users))
+        logger.info("User columns: %s", list(df_users.columns))
         
-        return restaurant_profiles, user_profiles
+        return df_users
         
     except Exception as e:
-        logger.error("Preprocessing failed: %s", str(e))
+        logger.error("Failed to fetch users: %s", str(e))
+        logger.error("Traceback: %s", traceback.format_exc())
         raise
 
 
 @task(
     name="Compute Similarity Matrix"
 )
-def task_compute_similarity(restaurant_profiles, user_profiles):
+def task_compute_similarity(df_restaurants, df_users, top_k=None):
     logger = get_run_logger()
     logger.info("Computing similarity matrix...")
     
     try:
-        df_recommendations = rec.compute_similarity(restaurant_profiles, user_profiles)
+        logger.info("Avg tags per restaurant: %.2f", df_restaurants.groupby('restaurant_id').size().mean())
+        logger.info("Avg tags per user: %.2f", df_users.groupby('user_id').size().mean())
+        
+        df_recommendations = rec.compute_similarity(df_restaurants, df_users, top_k=top_k)
         
         # Statistics
         logger.info("Generated %d recommendations", len(df_recommendations))
@@ -113,51 +120,29 @@ def task_compute_similarity(restaurant_profiles, user_profiles):
 
 
 @task(
-    name="Write to Database",
+    name="Publish Recommendations",
     cache_policy=NO_CACHE,
     retries=2,
     retry_delay_seconds=5
 )
-def task_write_DB(env, df_recommendations):
+def task_publish(env, df_recommendations):
     logger = get_run_logger()
     logger.info("Writing %d recommendations to database...", len(df_recommendations))
     
     try:
-        con, cursor = rec.connect_db(env)
-        
-        # Get count before deletion
-        cursor.execute("SELECT COUNT(*) FROM recommendation")
-        old_count = cursor.fetchone()[0]
-        logger.info("Existing recommendations in DB: %d", old_count)
-        
-        rec.write_DB(con, cursor, df_recommendations)
-        con.close()
-        
-        logger.info("Recommendations saved successfully")
-        logger.info("Deleted: %d, Inserted: %d", old_count, len(df_recommendations))
-        
-    except Exception as e:
-        logger.error("Failed to write to database: %s", str(e))
-        raise
-
-
-@task(
-    name="Create Database View",
-    cache_policy=NO_CACHE,
-    retries=2,
-    retry_delay_seconds=5
-)
-def task_create_view(env):
-    logger = get_run_logger()
-    logger.info("Creating recommendation view...")
-    
-    try:
-        con, cursor = rec.connect_db(env)
-        rec.create_view(cursor, con)
-        logger.info("View created successfully")
+        # One connection for both the insert and the view
+        with rec.db_conn(env) as con, con.cursor() as cursor:
+            deleted = rec.write_DB(con, cursor, df_recommendations)
+            logger.info("Recommendations saved successfully")
+            logger.info("Upserted: %d", len(df_recommendations))
+            logger.info("Deleted stale: %d", deleted)
+            
+            logger.info("Refreshing recommendation view...")
+            rec.create_view(cursor, con)
+            logger.info("View refreshed successfully")
         
     except Exception as e:
-        logger.error("Failed to create view: %s", str(e))
+        logger.error("Failed to publish recommendations: %s", str(e))
         raise
 
 
@@ -169,13 +154,14 @@ def task_create_view(env):
     version="2.0",
     retries=1,
     retry_delay_seconds=30,
+    task_runner=ConcurrentTaskRunner(),
     log_prints=True,
     persist_result=True,
     result_storage=None,  
     timeout_seconds=3600,  # 1 hour timeout
     validate_parameters=True
 )
-def recommend_pipeline():
+def recommend_pipeline(top_k: Optional[int] = None):
     logger = get_run_logger()
     
     logger.info("="*70)
@@ -186,20 +172,18 @@ def recommend_pipeline():
         # Step 1: Load environment
         env = task_load_env()
         
-        # Step 2: Fetch data
-        df_restaurants, df_users = task_fetch_data(env)
-        
-        # Step 3: Preprocess
-        restaurant_profiles, user_profiles = task_preprocess(df_restaurants, df_users)
-        
-        # Step 4: Compute similarity
-        df_recommendations = task_compute_similarity(restaurant_profiles, user_profiles)
+        # Step 2: Fetch restaurants and users concurrently
+        restaurants_future = task_fetch_restaurants.submit(env)
+        users_future = task_fetch_users.submit(env)
+        df_restaurants = restaurants_future.result()
+        df_users = users_future.result()
         
-        # Step 5: Write to database
-        task_write_DB(env, df_recommendations)
+        # Step 3: Compute similarity
+        # top_k=None keeps every user-restaurant pair
+        df_recommendations = task_compute_similarity(df_restaurants, df_users, top_k)
         
-        # Step 6: Create view
-        task_create_view(env)
+        # Step 4: Write to database and create view
+        task_publish(env, df_recommendations)
         
         logger.info("="*70)
         logger.info("Pipeline completed successfully!")
@@ -0,0 +1,12 @@
+-- One-time setup for write_DB, which upserts ON CONFLICT (user_id, restaurant_id).
+-- Run once with psql before deploying; CONCURRENTLY cannot run inside a transaction.
+
+-- Keep one row per (user_id, restaurant_id) so the unique index can be built
+DELETE FROM recommendation a
+USING recommendation b
+WHERE a.user_id = b.user_id
+  AND a.restaurant_id = b.restaurant_id
+  AND a.ctid < b.ctid;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS recommendation_user_restaurant_idx
+ON recommendation (user_id, restaurant_id);
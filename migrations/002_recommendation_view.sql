@@ -0,0 +1,39 @@
+-- One-time setup for create_view, which only runs
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY recommendation_view.
+-- Run after 001 (the view's unique index relies on unique pairs). To change
+-- the view query, add a new migration that drops and recreates it.
+
+BEGIN;
+
+-- Replace the plain view from earlier deployments
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_views
+        WHERE schemaname = current_schema() AND viewname = 'recommendation_view'
+    ) THEN
+        DROP VIEW recommendation_view;
+    END IF;
+END $$;
+
+DROP MATERIALIZED VIEW IF EXISTS recommendation_view;
+
+-- Ranking is computed once per refresh instead of on every read. A
+-- materialized view keeps no row order, so readers add their own ORDER BY
+CREATE MATERIALIZED VIEW recommendation_view AS
+SELECT
+    r.user_id,
+    r.restaurant_id,
+    r.score,
+    r.updated_at,
+    ROW_NUMBER() OVER (
+        PARTITION BY r.user_id
+        ORDER BY r.score DESC
+    ) AS rank
+FROM recommendation r;
+
+-- REFRESH ... CONCURRENTLY needs a unique index
+CREATE UNIQUE INDEX recommendation_view_user_restaurant_idx
+ON recommendation_view (user_id, restaurant_id);
+
+COMMIT;
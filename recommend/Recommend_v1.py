@@ -1,12 +1,22 @@
 import pandas as pd
 import numpy as np
 import psycopg2
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 from os.path import join, dirname
 import os
+import io
+import csv
+import hashlib
+import tempfile
+from glob import glob
+from scipy import sparse
+from itertools import chain
+# sibling module; the script is run as python recommend/Recommend_v1.py
+from topk_kernels import cos_topk, csr_topk, tag_matrix
+
+# RECOMMEND_CACHE_DIR overrides the cache root for runs from a fresh checkout
+CACHE_DIR = join(os.getenv('RECOMMEND_CACHE_DIR', join(dirname(__file__), 'cache')), 'v3')  # bump when features change
+
 
 try:
     # Load environment variables from .env file
@@ -35,15 +45,10 @@ try:
     else:
         print("[2] Connected to PostgreSQL database successfully.")
 
-    # Query restaurants
+    # Query restaurant profiles (tags are aggregated server-side)
     restaurant_query = """
         select b.restaurant_id,
-               a.name as restaurant_name,
-               a.address,
-               c.category_id,
-               d.name as category_name,
-               b.tag_id,
-               c.name as tag_name
+               array_agg(b.tag_id order by b.tag_id) as tag_ids
         from restaurants a
         inner join restaurant_tags b
             on a.id = b.restaurant_id
@@ -51,6 +56,8 @@ try:
             on c.id = b.tag_id
         inner join categories d 
             on d.id = c.category_id
+        group by b.restaurant_id
+        order by b.restaurant_id
     """
     # Get restaurants
     cursor.execute(restaurant_query)
@@ -62,19 +69,15 @@ try:
     if len(records_restaurant) == 0:
         raise ValueError("No restaurant data fetched.")
     else:
-        df_restaurants = pd.DataFrame(records_restaurant
-                                     ,columns=[desc[0] for desc in cursor.description])
-        print("sample restaurant data:")
-        print(df_restaurants.head(5))
+        restaurant_metrics = pd.DataFrame(records_restaurant
+                                         ,columns=[desc[0] for desc in cursor.description])
+        print("sample restaurant profile data:")
+        print(restaurant_metrics.head(5))
         
-    # Query users
+    # Query user profiles (tags are aggregated server-side)
     users_query = """
         select b.user_id,
-               a.username,
-               c.category_id,
-               d.name as category_name,
-               b.tag_id,
-               c.name as tag_name
+               array_agg(b.tag_id order by b.tag_id) as tag_ids
         from users a
         inner join user_tags b
             on b.user_id = a.id
@@ -82,6 +85,8 @@ try:
             on c.id = b.tag_id
         inner join categories d 
             on d.id = c.category_id
+        group by b.user_id
+        order by b.user_id
     """
     # Get users
     cursor.execute(users_query)
@@ -93,110 +98,156 @@ try:
     if len(records_users) == 0:
         raise ValueError("No user data fetched.")
     else:
-        df_users = pd.DataFrame(records_users
-                                ,columns=[desc[0] for desc in cursor.description])
-        print("sample users data:")
-        print(df_users.head(5))
-
-    # Create profiles
-    print("[5] Creating profiles...")
-    if df_restaurants.empty or df_users.empty:
-        raise ValueError("No data fetched from the database.")
-    else:
-        restaurant_metrics = df_restaurants.groupby(["restaurant_id"])["tag_name"] \
-                                           .apply(lambda x: ' | '.join(x)) \
-                                           .reset_index(name="restaurantCharacteristics")
-        print("sample restaurant profile data:")
-        print(restaurant_metrics.head(5))
-        
-        user_metrics = df_users.groupby(["user_id"])["tag_name"] \
-                               .apply(lambda x: " ".join(x)) \
-                               .reset_index(name="userCharacteristics")
+        user_metrics = pd.DataFrame(records_users
+                                   ,columns=[desc[0] for desc in cursor.description])
         print("sample user profile data:")
         print(user_metrics.head(5))
 
-    # TF-IDF Vectorization
-    print("[6] Performing TF-IDF vectorization...")
+    # Tag vectors
+    print("[5] Building tag vectors...")
     if restaurant_metrics.empty or user_metrics.empty:
-        raise ValueError("No data available for TF-IDF vectorization.")
+        raise ValueError("No data available for tag vectorization.")
     else:
-        # Initialize TF-IDF Vectorizer
-        vectorizer = TfidfVectorizer()
+        # Profiles are tag sets, so each one is a binary tag-incidence row
+        # built straight from tag_id; no text tokenization is involved
+        tag_index = pd.Index(sorted(set(chain.from_iterable(restaurant_metrics["tag_ids"]))))
+        restaurant_vecs, restaurant_tag_counts = tag_matrix(restaurant_metrics["tag_ids"], tag_index)
+
+        # Cached top-k rows are only valid for the same restaurant tag sets
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        signature = hashlib.md5(
+            pd.util.hash_pandas_object(restaurant_metrics.astype({"tag_ids": str}), index=False).values
+        ).hexdigest()
 
-        # Fit all data to ensure consistent feature space
-        all_text = pd.concat([user_metrics["userCharacteristics"]
-                            , restaurant_metrics["restaurantCharacteristics"]])
-        vectorizer.fit(all_text)
+        # Reuse top-k rows of users whose profile did not change since the
+        # last run against the same restaurant vectors
+        k = min(5, len(restaurant_metrics))  # recommendations per user
+        n_users = len(user_metrics)
+        user_hashes = pd.util.hash_pandas_object(user_metrics.astype({"tag_ids": str}), index=False).to_numpy()
+        top_k_idx = np.empty((n_users, k), dtype=np.int32)
+        top_k_scores = np.empty((n_users, k), dtype=np.float32)
+        cached_pos = np.full(n_users, -1)
+        top_k_path = join(CACHE_DIR, f"topk_{signature}.npz")
+        if os.path.exists(top_k_path):
+            with np.load(top_k_path) as cached:
+                if cached["top_k_idx"].shape[1] == k:
+                    cached_pos = pd.Index(cached["user_hashes"]).get_indexer(user_hashes)
+                    reused = cached_pos >= 0
+                    top_k_idx[reused] = cached["top_k_idx"][cached_pos[reused]]
+                    top_k_scores[reused] = cached["top_k_scores"][cached_pos[reused]]
+        stale_rows = np.flatnonzero(cached_pos < 0)
+        print(f"Reusing cached recommendations for {n_users - len(stale_rows)} users.")
 
-        # Transform metrics
-        user_vecs = vectorizer.transform(user_metrics["userCharacteristics"])
-        restaurant_vecs = vectorizer.transform(restaurant_metrics["restaurantCharacteristics"])
+        # Vectorize only new or changed users; user tags no restaurant has
+        # cannot match, but still count towards the user's norm
+        user_vecs, user_tag_counts = tag_matrix(user_metrics["tag_ids"].iloc[stale_rows], tag_index)
 
         # Compute cosine similarity
-        print("[7] Computing cosine similarity...")
-        if user_vecs.shape[0] == 0 or restaurant_vecs.shape[0] == 0:
-            raise ValueError("TF-IDF vectorization resulted in empty matrices.")
-        else:
-            similarity = cosine_similarity(user_vecs, restaurant_vecs)
-        
+        print("[6] Computing cosine similarity...")
+        if restaurant_vecs.shape[0] == 0:
+            raise ValueError("Tag vectorization resulted in empty matrices.")
+
         # get top-k recommendations
-        print("[8] Generating recommendations...")
-        k = 5  # number of recommendations per user
-        recommendations = []
-        for user_idx, user_id in enumerate(user_metrics["user_id"]):
-            # get top-k indices
-            top_k_idx = np.argpartition(-similarity[user_idx], k)[:k]
-            # sort top-k indices by similarity score
-            top_k_sorted = top_k_idx[np.argsort(-similarity[user_idx][top_k_idx])]
-            for restaurant_idx in top_k_sorted:
-                recommendations.append((
-                    int(user_id),
-                    int(restaurant_metrics.iloc[restaurant_idx]["restaurant_id"]),
-                    float(similarity[user_idx, restaurant_idx])
-                ))
-
-        df_recommendations = pd.DataFrame(recommendations
-                                        , columns=["user_id", "restaurant_id", "score"])
+        print("[7] Generating recommendations...")
+        n_restaurants = restaurant_vecs.shape[0]
+        # process users in blocks so only block_size x n_restaurants scores
+        # are resident at a time (sized to roughly fit a 1 MiB L2 cache)
+        block_size = int(min(1024, max(1, (1 << 20) // (4 * n_restaurants))))
+        # dividing binary rows by sqrt(tag count) makes the dot the cosine
+        user_scale = 1 / np.sqrt(user_tag_counts, dtype=np.float32)
+        restaurant_scale = 1 / np.sqrt(restaurant_tag_counts, dtype=np.float32)
+        # user/restaurant pairs sharing a tag bound the nonzero similarities
+        max_nnz = int(user_vecs.getnnz(axis=0).astype(np.int64)
+                      @ restaurant_vecs.getnnz(axis=0).astype(np.int64))
+        if max_nnz < 0.1 * len(stale_rows) * n_restaurants:
+            # most pairs share no tag, so keep the similarity sparse and rank
+            # only its nonzeros instead of materializing users x restaurants
+            similarity = (
+                sparse.diags(user_scale) @ user_vecs.astype(np.float32)
+                @ (sparse.diags(restaurant_scale) @ restaurant_vecs.astype(np.float32)).T
+            ).tocsr()
+            stale_idx, stale_scores = csr_topk(similarity.indptr
+                                              ,similarity.indices
+                                              ,similarity.data
+                                              ,n_restaurants
+                                              ,k)
+        else:
+            # the tag vocabulary is small, so dense float32 rows are cheap and
+            # let the whole similarity + top-k pass run in one compiled kernel
+            user_dense = user_vecs.toarray().astype(np.float32) * user_scale[:, None]
+            restaurant_dense = restaurant_vecs.toarray().astype(np.float32) * restaurant_scale[:, None]
+            stale_idx, stale_scores = cos_topk(user_dense
+                                              ,restaurant_dense
+                                              ,k
+                                              ,block_size)
+        top_k_idx[stale_rows] = stale_idx
+        top_k_scores[stale_rows] = stale_scores
+        # write to a temp file and rename it into place so no run ever loads
+        # a half-written cache, then drop caches of older restaurant sets
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix="topk_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f
+                        ,user_hashes=user_hashes
+                        ,top_k_idx=top_k_idx
+                        ,top_k_scores=top_k_scores)
+            os.replace(tmp_path, top_k_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        for old_path in glob(join(CACHE_DIR, "topk_*.npz")):
+            if old_path != top_k_path:
+                os.remove(old_path)
+
+        df_recommendations = pd.DataFrame({
+            "user_id": np.repeat(user_metrics["user_id"].to_numpy(), k),
+            "restaurant_id": restaurant_metrics["restaurant_id"].to_numpy()[top_k_idx.ravel()],
+            "score": top_k_scores.ravel()
+        })
         print("sample recommendations data:")
         print(df_recommendations.head(5))
         
         if df_recommendations.empty:
             raise ValueError("No recommendations to insert into the database.")
 
-        # Clear existing recommendations for the users
-        print("[9] Deleting existing recommendations...")         
-        user_ids = df_recommendations["user_id"].unique()
-        user_ids = [int(u) for u in user_ids]
-        cursor.execute("DELETE FROM recommendation WHERE user_id = ANY(%s)", (list(user_ids),))
-        print(f"Deleted existing recommendations for {len(user_ids)} users.")
-        connection.commit()
+        # Stage new recommendations
+        print("[8] Staging new recommendations...")
+        # stream rows through COPY into a temp table dropped at commit
+        cursor.execute("""
+            CREATE TEMP TABLE rec_stage ON COMMIT DROP AS
+            SELECT user_id, restaurant_id, score FROM recommendation WITH NO DATA
+        """)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(df_recommendations.itertuples(index=False, name=None))
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY rec_stage (user_id, restaurant_id, score) FROM STDIN WITH CSV"
+           ,buffer
+        )
 
-        # Insert new recommendations
-        print("[10] Inserting new recommendations...")
-        insert_query = """
+        # Clear existing recommendations for the staged users with a join
+        # instead of an ANY(array) predicate
+        print("[9] Replacing existing recommendations...")
+        cursor.execute("""
+            DELETE FROM recommendation r
+            USING (SELECT DISTINCT user_id FROM rec_stage) s
+            WHERE r.user_id = s.user_id
+        """)
+        print(f"Deleted {cursor.rowcount} existing recommendations.")
+        cursor.execute("""
             INSERT INTO recommendation (user_id, restaurant_id, score)
-            VALUES %s
-        """
-        execute_values(cursor
-                      ,insert_query
-                      ,df_recommendations.values.tolist())
+            SELECT user_id, restaurant_id, score FROM rec_stage
+        """)
         print(f"Inserted {len(df_recommendations)} recommendations into DB")
         print("Sample inserted recommendations:")
         print(df_recommendations.head(5))
 
-        # create of replace recommendation view
-        print("[11] Creating or replacing recommendation view...")
-        cursor.execute("""
-            CREATE OR REPLACE VIEW recommendation_view AS
-            SELECT r.id as recommendation_id,
-                u.username as user_name,
-                res.name as restaurant_name,
-                r.score
-            FROM recommendation r
-            JOIN users u ON r.user_id = u.id
-            JOIN restaurants res ON r.restaurant_id = res.id
-        """)
-        print("Recommendation view created or replaced successfully.")
+        # refresh materialized recommendation view
+        print("[10] Refreshing recommendation view...")
+        # the view and its unique index come from
+        # migrations/002_recommendation_view.sql
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recommendation_view")
+        print("Recommendation view refreshed successfully.")
 
         connection.commit()
         print("All changes committed to the database.")
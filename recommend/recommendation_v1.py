@@ -1,13 +1,36 @@
 from dotenv import load_dotenv
 import os
+import io
 from os.path import join, dirname, abspath
 from pathlib import Path
-import psycopg2
-from psycopg2.extras import execute_values
+import threading
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.pool import ThreadedConnectionPool
 import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix, diags
+from sklearn.preprocessing import normalize
+import joblib
+
+# CuPy is optional; without it everything runs on the CPU
+try:
+    import cupy as cp
+    import cupyx.scipy.sparse as cpsparse
+except ImportError:
+    cp = None
+
+# Restaurant tag matrices cached between runs. Deployments clone a fresh
+# checkout per run, so point RECOMMEND_CACHE_DIR at persistent storage there
+CACHE_DIR = Path(os.getenv('RECOMMEND_CACHE_DIR', Path(__file__).parent / 'cache'))
+# Users scored per dense block in compute_similarity when only top-k is kept
+SIMILARITY_BLOCK_SIZE = 1024
+# Threads scoring user blocks concurrently; more adds little past 3-4
+SIMILARITY_N_JOBS = 4
+# User-restaurant pairs above which top-k scoring moves to the GPU, if any
+GPU_MIN_PAIRS = 10**8
 
 # ------------ 1. load environment variables ------------
 def load_env_variables():
@@ -33,177 +56,296 @@ def load_env_variables():
     return env_vars
     
 # ------------ 2. connect to PostgreSQL database ------------
+_pool = None
+_pool_lock = threading.Lock()
+
+def init_pool(env):
+    # One pool per process so Prefect tasks share connections instead of
+    # paying a TCP + TLS + auth handshake each
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(
+                1, 8,
+                host=env["DB_HOST"],
+                database=env["DB_NAME"],
+                user=env["DB_USER"],
+                password=env["DB_PASSWORD"],
+                port='35911',
+                sslmode='require',
+                client_encoding='UTF8',
+                # TCP keepalives stop connections idling in the pool while
+                # similarity runs from being dropped by idle timeouts
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3
+            )
+    return _pool
+
 def connect_db(env):
     try:
-        con = psycopg2.connect(
-            host=env["DB_HOST"],
-            database=env["DB_NAME"],
-            user=env["DB_USER"],
-            password=env["DB_PASSWORD"],
-            port='35911',
-            sslmode='require',
-            client_encoding='UTF8'
-        )
-        cursor = con.cursor()
-        return con, cursor
+        pool = init_pool(env)
+        # A connection the server dropped while it sat in the pool still
+        # reads as open, so ping each one before handing it out. After a
+        # network blip several idle ones may be dead; the last attempt always
+        # gets a freshly opened connection
+        for _ in range(pool.maxconn + 1):
+            con = pool.getconn()
+            try:
+                with con.cursor() as ping:
+                    ping.execute("SELECT 1")
+                con.rollback()
+                return con
+            except (OperationalError, InterfaceError):
+                pool.putconn(con, close=True)
+        raise OperationalError("No live database connection available from the pool")
     except Exception as e:
         print(f"Error connecting to database: {e}")
         raise
 
+def release_db(con):
+    # Hand the connection back to the pool instead of closing it
+    _pool.putconn(con)
+
+@contextmanager
+def db_conn(env):
+    # Borrow one pooled connection for a whole with block; callers open
+    # cursors only where they need them
+    con = connect_db(env)
+    try:
+        yield con
+    finally:
+        release_db(con)
+
 # ------------- 3. query restaurants --------------------------
-def fetch_datas(cursor):
+def copy_to_dataframe(con, query):
+    buffer = io.StringIO()
+    with con.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buffer)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+def fetch_restaurants(con):
     try:
-        # Query restaurants
+        # Query restaurant tags. Only the ids feed the similarity; the joins
+        # stay as filters so the rows are the same as before
         restaurant_query = """
             select b.restaurant_id,
-                a.name as restaurant_name,
-                a.address,
-                c.category_id,
-                d.name as category_name,
-                b.tag_id,
-                c.name as tag_name
+                b.tag_id
             from restaurants a
             inner join restaurant_tags b on a.id = b.restaurant_id
             inner join tags c on c.id = b.tag_id
             inner join categories d on d.id = c.category_id
         """
-        cursor.execute(restaurant_query)
-        restaurant_data = cursor.fetchall()
-        df_restaurants = pd.DataFrame(
-            restaurant_data, columns=[desc[0] for desc in cursor.description]
-        )
-        
-        # Query users
+        # COPY streams the result as CSV in one round trip and pandas parses
+        # it directly instead of building a Python tuple per row
+        df_restaurants = copy_to_dataframe(con, restaurant_query)
+
+        return df_restaurants
+    except Exception as e:
+        print(f"Error failed to fetch restaurants: {e}")
+        raise
+
+def fetch_users(con):
+    try:
+        # Query user tags
         users_query = """
             select b.user_id,
-                a.username,
-                c.category_id,
-                d.name as category_name,
-                b.tag_id,
-                c.name as tag_name
+                b.tag_id
             from users a
             inner join user_tags b on b.user_id = a.id
             inner join tags c on c.id = b.tag_id
             inner join categories d on d.id = c.category_id
         """
-        cursor.execute(users_query)
-        user_date = cursor.fetchall()
-        df_users = pd.DataFrame(
-            user_date, columns=[desc[0] for desc in cursor.description]
-        )
+        df_users = copy_to_dataframe(con, users_query)
 
-        return df_restaurants, df_users
+        return df_users
     except Exception as e:
-        print(f"Error failed to fetch data: {e}")
+        print(f"Error failed to fetch users: {e}")
         raise
 
-# ------------- 4. preprocess data --------------------------
-def preprocess_data(df_restaurants, df_users):
+# ------------- 4. compute similarity --------------------------
+def compute_similarity(df_restaurants, df_users, top_k=None):
     try:
-        # Aggregate tags for each restaurant
-        restaurant_profiles = (
-            df_restaurants.groupby("restaurant_id")["tag_name"]
-                          .apply(lambda x: ' | '.join(x))
-                          .reset_index(name="restaurantCharacteristics")
+        # Tags come from a controlled vocabulary, so each profile is a row of
+        # a tag-incidence matrix built straight from the integer tag_id
+        # instead of joining tag names and re-tokenizing them. The vocabulary
+        # and IDF weights come from restaurants only, so the weighted
+        # restaurant rows only change with the catalog and are cached on disk
+        # keyed by a fingerprint of the (restaurant_id, tag_id) pairs. They
+        # are cached already transposed to tag x restaurant CSR, the layout
+        # the product with the user rows reads, so no run has to convert it
+        restaurant_pairs = df_restaurants[["restaurant_id", "tag_id"]].sort_values(
+            ["restaurant_id", "tag_id"]
         )
+        fingerprint = hashlib.sha1(
+            pd.util.hash_pandas_object(restaurant_pairs, index=False).values
+        ).hexdigest()
+        cache_path = CACHE_DIR / f"restaurant_vec_t_{fingerprint}.joblib"
+        if cache_path.exists():
+            restaurant_vec_t, restaurant_ids, tag_ids, idf = joblib.load(cache_path)
+        else:
+            restaurant_rows, restaurant_ids = pd.factorize(df_restaurants["restaurant_id"], sort=True)
+            restaurant_cols, tag_ids = pd.factorize(df_restaurants["tag_id"])
+            restaurant_mat = csr_matrix(
+                (np.ones(len(df_restaurants), dtype=np.float32), (restaurant_rows, restaurant_cols)),
+                shape=(len(restaurant_ids), len(tag_ids))
+            )
+            # Smoothed IDF from tag document frequencies, as TfidfVectorizer
+            # computes it: ln((1 + n) / (1 + df)) + 1
+            doc_freq = np.bincount(restaurant_mat.indices, minlength=len(tag_ids))
+            idf = np.log((1 + len(restaurant_ids)) / (1 + doc_freq)).astype(np.float32) + 1
+            restaurant_vec = normalize(restaurant_mat @ diags(idf), norm='l2', copy=False)
+            restaurant_vec_t = restaurant_vec.T.tocsr()
+            # Write to a temp file and rename it into place so another run
+            # never loads a half-written cache, then drop older catalogs
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix="restaurant_vec_t_", suffix=".tmp")
+            os.close(fd)
+            try:
+                joblib.dump((restaurant_vec_t, restaurant_ids, tag_ids, idf), tmp_path)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            for old_path in CACHE_DIR.glob("restaurant_vec_t_*.joblib"):
+                if old_path != cache_path:
+                    old_path.unlink(missing_ok=True)
 
-        # Aggregate tags for each user
-        user_profiles = (
-            df_users.groupby("user_id")["tag_name"]
-                    .apply(lambda x: ' | '.join(x))
-                    .reset_index(name="userCharacteristics")
+        # User tags no restaurant has cannot match any restaurant, so they
+        # are dropped like unseen tokens in a fitted vectorizer
+        user_rows, user_ids = pd.factorize(df_users["user_id"], sort=True)
+        user_cols = pd.Index(tag_ids).get_indexer(df_users["tag_id"])
+        known = user_cols >= 0
+        n_users = len(user_ids)
+        n_restaurants = len(restaurant_ids)
+        user_mat = csr_matrix(
+            (np.ones(known.sum(), dtype=np.float32), (user_rows[known], user_cols[known])),
+            shape=(n_users, len(tag_ids))
         )
+        user_vec = normalize(user_mat @ diags(idf), norm='l2', copy=False)
 
-        return restaurant_profiles, user_profiles
+        # Rows are L2-normalized, so the sparse dot product is the cosine
+        # similarity (and stays float32). Ids keep 64 bits so bigint keys are
+        # never narrowed
+        user_ids = user_ids.to_numpy(dtype=np.int64)
+        restaurant_ids = restaurant_ids.to_numpy(dtype=np.int64)
+        if top_k is None:
+            # All user–restaurant combinations, in the matrix's row-major order
+            similarity_matrix = (user_vec @ restaurant_vec_t).toarray()
+            rec_user_ids = np.repeat(user_ids, n_restaurants)
+            rec_restaurant_ids = np.tile(restaurant_ids, n_users)
+            rec_scores = similarity_matrix.ravel().astype(np.float32, copy=False)
+        else:
+            # Top-k restaurants per user, best first; users are processed in
+            # blocks so only a few blocks of the dense product exist at a
+            # time, and the blocks are spread over threads since the sparse
+            # product and argpartition release the GIL
+            k = min(top_k, n_restaurants)
+            top_idx = np.empty((n_users, k), dtype=np.int32)
+            top_scores = np.empty((n_users, k), dtype=np.float32)
+            if cp is not None and n_users * n_restaurants >= GPU_MIN_PAIRS:
+                # Large catalogs: the same blocks run one after another on
+                # the GPU against a single device copy of the restaurants
+                xp, n_jobs = cp, 1
+                to_device, to_host = cpsparse.csr_matrix, cp.asnumpy
+            else:
+                xp, n_jobs = np, SIMILARITY_N_JOBS
+                to_device, to_host = (lambda m: m), np.asarray
+            restaurant_side = to_device(restaurant_vec_t)
 
-    except Exception as e:
-        print(f"Error in preprocess_data: {e}")
-        raise
+            def score_block(start, end):
+                block = (to_device(user_vec[start:end]) @ restaurant_side).toarray()
+                part = xp.argpartition(-block, k - 1, axis=1)[:, :k]
+                scores = xp.take_along_axis(block, part, axis=1)
+                order = xp.argsort(-scores, axis=1)
+                top_idx[start:end] = to_host(xp.take_along_axis(part, order, axis=1))
+                top_scores[start:end] = to_host(xp.take_along_axis(scores, order, axis=1))
 
-# ------------- 5. compute similarity --------------------------
-def compute_similarity(restaurant_profiles, user_profiles):
-    try:
-        # Combine all characteristics for TF-IDF vectorization
-        vectorizer = TfidfVectorizer()
-        all_characteristics = pd.concat([
-            user_profiles["userCharacteristics"],
-            restaurant_profiles["restaurantCharacteristics"]
-        ])
-        vectorizer.fit(all_characteristics)
-
-        # Transform user and restaurant characteristics
-        user_vec = vectorizer.transform(user_profiles["userCharacteristics"])
-        restaurant_vec = vectorizer.transform(restaurant_profiles["restaurantCharacteristics"])
-
-        # Compute cosine similarity
-        similarity_matrix = cosine_similarity(user_vec, restaurant_vec)
-
-        # Create a DataFrame for all user–restaurant combinations
-        recommendations = []
-        for user_idx, user_id in enumerate(user_profiles["user_id"]):
-            for restaurant_idx, restaurant_id in enumerate(restaurant_profiles["restaurant_id"]):
-                recommendations.append((
-                    int(user_id),
-                    int(restaurant_id),
-                    float(similarity_matrix[user_idx, restaurant_idx])
-                ))
-
-        df_recommendations = pd.DataFrame(
-            recommendations,
-            columns=["user_id", "restaurant_id", "score"]
-        )
+            joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+                joblib.delayed(score_block)(start, min(start + SIMILARITY_BLOCK_SIZE, n_users))
+                for start in range(0, n_users, SIMILARITY_BLOCK_SIZE)
+            )
+            rec_user_ids = np.repeat(user_ids, k)
+            rec_restaurant_ids = restaurant_ids[top_idx.ravel()]
+            rec_scores = top_scores.ravel()
+
+        df_recommendations = pd.DataFrame({
+            "user_id": rec_user_ids,
+            "restaurant_id": rec_restaurant_ids,
+            "score": rec_scores
+        })
         return df_recommendations
 
     except Exception as e:
         print(f"Error in compute_similarity: {e}")
         raise
 
-# ------------- 6. write to DataBase --------------------------
+# ------------- 5. write to DataBase --------------------------
 def write_DB(con, cursor, df_recommendations):
     try:
-        # Delete old recommendations
-        user_ids = df_recommendations["user_id"].unique()
-        user_ids = [int(u) for u in user_ids]
-        cursor.execute("TRUNCATE TABLE recommendation RESTART IDENTITY CASCADE")
-        con.commit()
-
-        # Insert new recommendations
-        insert_query = """
+        # Upsert on the (user_id, restaurant_id) key instead of truncating and
+        # reinserting, so pairs that are still recommended are rewritten only
+        # when their score changed. The unique index this relies on comes
+        # from migrations/001_recommendation_user_restaurant_idx.sql
+        # COPY the new rows into a transaction-scoped stage table, which
+        # skips per-statement parsing and planning, then upsert from it.
+        # The stage takes its column types from recommendation itself
+        cursor.execute(
+            """
+            CREATE TEMP TABLE recommendation_stage ON COMMIT DROP AS
+            SELECT user_id, restaurant_id, score FROM recommendation
+            WITH NO DATA
+            """
+        )
+        buffer = io.StringIO()
+        df_recommendations[["user_id", "restaurant_id", "score"]].to_csv(
+            buffer, index=False, header=False
+        )
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY recommendation_stage (user_id, restaurant_id, score) FROM STDIN WITH CSV",
+            buffer
+        )
+        cursor.execute(
+            """
             INSERT INTO recommendation (user_id, restaurant_id, score)
-            VALUES %s
-        """
-        execute_values(cursor, insert_query, df_recommendations.values.tolist())
+            SELECT user_id, restaurant_id, score FROM recommendation_stage
+            ON CONFLICT (user_id, restaurant_id) DO UPDATE
+            SET score = EXCLUDED.score, updated_at = now()
+            WHERE recommendation.score IS DISTINCT FROM EXCLUDED.score
+            """
+        )
+
+        # Drop the pairs that are no longer recommended
+        cursor.execute(
+            """
+            DELETE FROM recommendation r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM recommendation_stage s
+                WHERE s.user_id = r.user_id AND s.restaurant_id = r.restaurant_id
+            )
+            """
+        )
+        deleted = cursor.rowcount
         con.commit()
+        return deleted
 
     except Exception as e:
         print(f"Error in write_DB: {e}")
         con.rollback()
         raise
 
-# ------------------ 7. create view  -----------------------
+# ------------------ 6. create view  -----------------------
 def create_view(cursor, con):
     try:
-        cursor.execute(
-            """
-            CREATE OR REPLACE VIEW recommendation_view AS
-            SELECT
-                r.user_id,
-                r.restaurant_id,
-                r.score,
-                r.updated_at,
-                ROW_NUMBER() OVER (
-                    PARTITION BY r.user_id
-                    ORDER BY r.score DESC
-                ) AS rank
-            FROM recommendation r
-            ORDER BY r.user_id, r.score DESC
-            """
-        )
+        # The view and its unique index come from
+        # migrations/002_recommendation_view.sql; CONCURRENTLY keeps it
+        # readable while it refreshes
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY recommendation_view")
         con.commit()
     except Exception as e:
         print(f"Error in create_view: {e}")
         con.rollback()
-        raise
-    finally:
-        cursor.close()
-        con.close()
\ No newline at end of file
+        raise
\ No newline at end of file
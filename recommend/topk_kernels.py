@@ -0,0 +1,89 @@
+# Compiled top-k kernels and tag matrices used by Recommend_v1.py, kept in
+# their own module so they import without connecting to the database
+import numpy as np
+from scipy import sparse
+from itertools import chain
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def cos_topk(user_dense, restaurant_dense, k, block_size):
+    # rows are L2-normalized, so each dot product is already the cosine;
+    # never rank more slots than there are restaurants to fill them
+    k = min(k, restaurant_dense.shape[0])
+    n_users = user_dense.shape[0]
+    n_blocks = (n_users + block_size - 1) // block_size
+    restaurant_dense_t = np.ascontiguousarray(restaurant_dense.T)
+    top_k_idx = np.full((n_users, k), -1, dtype=np.int32)
+    top_k_scores = np.full((n_users, k), -1.0, dtype=np.float32)
+    for block in prange(n_blocks):
+        start = block * block_size
+        end = min(start + block_size, n_users)
+        block_sim = np.dot(user_dense[start:end], restaurant_dense_t)
+        for i in range(end - start):
+            row_idx = top_k_idx[start + i]
+            row_scores = top_k_scores[start + i]
+            # keep the k best scores sorted in descending order
+            for j in range(block_sim.shape[1]):
+                score = block_sim[i, j]
+                if score > row_scores[k - 1]:
+                    pos = k - 1
+                    while pos > 0 and row_scores[pos - 1] < score:
+                        row_scores[pos] = row_scores[pos - 1]
+                        row_idx[pos] = row_idx[pos - 1]
+                        pos -= 1
+                    row_scores[pos] = score
+                    row_idx[pos] = j
+    return top_k_idx, top_k_scores
+
+
+@njit(parallel=True, cache=True)
+def csr_topk(indptr, indices, data, n_cols, k):
+    # top-k over the stored entries of each CSR row; rows with fewer than k
+    # nonzeros are padded with the lowest zero-score column ids, so k can
+    # be at most the number of columns
+    k = min(k, n_cols)
+    n_rows = len(indptr) - 1
+    top_k_idx = np.full((n_rows, k), -1, dtype=np.int32)
+    top_k_scores = np.zeros((n_rows, k), dtype=np.float32)
+    for i in prange(n_rows):
+        row_idx = top_k_idx[i]
+        row_scores = top_k_scores[i]
+        filled = 0
+        for p in range(indptr[i], indptr[i + 1]):
+            score = data[p]
+            if filled < k or score > row_scores[k - 1]:
+                pos = filled if filled < k else k - 1
+                while pos > 0 and row_scores[pos - 1] < score:
+                    row_scores[pos] = row_scores[pos - 1]
+                    row_idx[pos] = row_idx[pos - 1]
+                    pos -= 1
+                row_scores[pos] = score
+                row_idx[pos] = indices[p]
+                filled = min(filled + 1, k)
+        j = 0
+        while filled < k and j < n_cols:
+            taken = False
+            for q in range(filled):
+                if row_idx[q] == j:
+                    taken = True
+            if not taken:
+                row_idx[filled] = j
+                filled += 1
+            j += 1
+    return top_k_idx, top_k_scores
+
+
+def tag_matrix(tag_lists, tag_index):
+    # binary tag-incidence rows over tag_index columns; tags outside the
+    # index are dropped but still counted in the returned row lengths
+    lengths = tag_lists.str.len().to_numpy()
+    tags = np.fromiter(chain.from_iterable(tag_lists), dtype=np.int64, count=lengths.sum())
+    rows = np.repeat(np.arange(len(tag_lists)), lengths)
+    cols = tag_index.get_indexer(tags)
+    known = cols >= 0
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum(), dtype=np.int8), (rows[known], cols[known]))
+       ,shape=(len(tag_lists), len(tag_index))
+    )
+    return matrix, lengths
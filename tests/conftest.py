@@ -0,0 +1,10 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Make the recommend package importable when pytest is run from anywhere
+sys.path.insert(0, str(ROOT))
+# Recommend_v1.py imports its kernels as the top-level topk_kernels module;
+# tests use the same name so numba's on-disk cache entries stay loadable
+sys.path.insert(0, str(ROOT / "recommend"))
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from recommend import recommendation_v1 as rec
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep the restaurant cache out of the package checkout
+    monkeypatch.setattr(rec, "CACHE_DIR", tmp_path)
+    return tmp_path
+
+
+def make_tags(id_col, n, rng):
+    rows = []
+    for i in rng.permutation(n):
+        for tag in rng.choice(12, rng.integers(1, 5), replace=False):
+            rows.append({id_col: int(i) * 3 + 1, "tag_id": int(tag) + 100})
+    return pd.DataFrame(rows)
+
+
+def reference_similarity(df_restaurants, df_users):
+    # TF-IDF fit on restaurant profiles only, then cosine via the dot product
+    def profiles(df, id_col):
+        return df.groupby(id_col)["tag_id"].agg(lambda tags: " ".join(f"t{t}" for t in tags))
+
+    restaurant_profiles = profiles(df_restaurants, "restaurant_id")
+    user_profiles = profiles(df_users, "user_id")
+    vectorizer = TfidfVectorizer().fit(restaurant_profiles)
+    similarity = (vectorizer.transform(user_profiles) @ vectorizer.transform(restaurant_profiles).T).toarray()
+    return similarity, user_profiles.index.to_numpy(), restaurant_profiles.index.to_numpy()
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return make_tags("restaurant_id", 40, rng), make_tags("user_id", 30, rng)
+
+
+def test_all_pairs_match_tfidf_vectorizer(data):
+    df_restaurants, df_users = data
+    expected, user_ids, restaurant_ids = reference_similarity(df_restaurants, df_users)
+
+    result = rec.compute_similarity(df_restaurants, df_users)
+
+    assert len(result) == expected.size
+    np.testing.assert_array_equal(result["user_id"].to_numpy(), np.repeat(user_ids, len(restaurant_ids)))
+    np.testing.assert_array_equal(result["restaurant_id"].to_numpy(), np.tile(restaurant_ids, len(user_ids)))
+    np.testing.assert_allclose(result["score"].to_numpy().reshape(expected.shape), expected, atol=1e-6)
+
+
+def test_top_k_matches_tfidf_vectorizer(data, monkeypatch):
+    df_restaurants, df_users = data
+    expected, _, _ = reference_similarity(df_restaurants, df_users)
+    # Several blocks, so rows written by different workers are covered
+    monkeypatch.setattr(rec, "SIMILARITY_BLOCK_SIZE", 7)
+
+    result = rec.compute_similarity(df_restaurants, df_users, top_k=5)
+
+    expected_top = -np.sort(-expected, axis=1)[:, :5]
+    np.testing.assert_allclose(result["score"].to_numpy(), expected_top.ravel(), atol=1e-6)
+
+
+def test_cached_restaurants_give_same_scores(data, cache_dir):
+    df_restaurants, df_users = data
+
+    first = rec.compute_similarity(df_restaurants, df_users)
+    second = rec.compute_similarity(df_restaurants.sample(frac=1, random_state=1), df_users)
+
+    assert len(list(cache_dir.glob("restaurant_vec_t_*.joblib"))) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_user_tags_unknown_to_restaurants_are_dropped(data):
+    df_restaurants, df_users = data
+    df_users = df_users.copy()
+    df_users.loc[0, "tag_id"] = 999
+    expected, _, _ = reference_similarity(df_restaurants, df_users)
+
+    result = rec.compute_similarity(df_restaurants, df_users)
+
+    np.testing.assert_allclose(result["score"].to_numpy().reshape(expected.shape), expected, atol=1e-6)
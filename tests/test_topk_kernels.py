@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from topk_kernels import cos_topk, csr_topk
+
+
+def normalized_rows(rng, n, dim):
+    rows = rng.random((n, dim), dtype=np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def brute_topk(similarity, k):
+    idx = np.argsort(-similarity, axis=1, kind="stable")[:, :k]
+    return idx, np.take_along_axis(similarity, idx, axis=1)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 1024])
+def test_cos_topk_matches_brute_force(block_size):
+    rng = np.random.default_rng(0)
+    users = normalized_rows(rng, 50, 8)
+    restaurants = normalized_rows(rng, 30, 8)
+
+    idx, scores = cos_topk(users, restaurants, 5, block_size)
+
+    expected_idx, expected_scores = brute_topk(users @ restaurants.T, 5)
+    np.testing.assert_array_equal(idx, expected_idx)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_cos_topk_with_fewer_restaurants_than_k():
+    rng = np.random.default_rng(1)
+    users = normalized_rows(rng, 4, 6)
+    restaurants = normalized_rows(rng, 3, 6)
+
+    idx, scores = cos_topk(users, restaurants, 5, 2)
+
+    assert idx.shape == scores.shape == (4, 3)
+    assert (np.sort(idx, axis=1) == np.arange(3)).all()
+    expected_idx, expected_scores = brute_topk(users @ restaurants.T, 3)
+    np.testing.assert_array_equal(idx, expected_idx)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_cos_topk_with_no_users():
+    rng = np.random.default_rng(2)
+    users = np.empty((0, 6), dtype=np.float32)
+    restaurants = normalized_rows(rng, 10, 6)
+
+    idx, scores = cos_topk(users, restaurants, 5, 4)
+
+    assert idx.shape == scores.shape == (0, 5)
+
+
+def brute_csr_topk(matrix, k):
+    # nonzeros by descending score, then the lowest zero-score column ids
+    k = min(k, matrix.shape[1])
+    idx = np.empty((matrix.shape[0], k), dtype=np.int64)
+    scores = np.zeros((matrix.shape[0], k), dtype=np.float32)
+    for i, row in enumerate(matrix.toarray()):
+        nonzero = np.flatnonzero(row)
+        nonzero = nonzero[np.argsort(-row[nonzero], kind="stable")]
+        zero = np.flatnonzero(row == 0)
+        order = np.concatenate([nonzero, zero])[:k]
+        idx[i] = order
+        scores[i] = row[order]
+    return idx, scores
+
+
+def run_csr_topk(matrix, k):
+    return csr_topk(matrix.indptr, matrix.indices, matrix.data, matrix.shape[1], k)
+
+
+def test_csr_topk_matches_brute_force():
+    rng = np.random.default_rng(3)
+    # sparse enough that many rows have fewer than k nonzeros
+    matrix = sparse.random(60, 40, density=0.08, format="csr", dtype=np.float32, random_state=rng)
+
+    idx, scores = run_csr_topk(matrix, 5)
+
+    expected_idx, expected_scores = brute_csr_topk(matrix, 5)
+    assert (np.diff(matrix.indptr) < 5).any()
+    np.testing.assert_array_equal(idx, expected_idx)
+    np.testing.assert_allclose(scores, expected_scores)
+
+
+def test_csr_topk_pads_short_rows_without_duplicates():
+    matrix = sparse.csr_matrix(np.array([
+        [0.0, 0.0, 0.9, 0.0, 0.0, 0.0, 0.3],
+        [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+        [0.5, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+    ], dtype=np.float32))
+
+    idx, scores = run_csr_topk(matrix, 5)
+
+    np.testing.assert_array_equal(idx, [[2, 6, 0, 1, 3], [0, 1, 2, 3, 4], [0, 1, 2, 3, 4]])
+    np.testing.assert_allclose(scores[0], [0.9, 0.3, 0, 0, 0])
+    for row in idx:
+        assert len(set(row)) == len(row)
+
+
+def test_csr_topk_with_fewer_columns_than_k():
+    matrix = sparse.csr_matrix(np.array([
+        [0.0, 0.4, 0.0],
+        [0.0, 0.0, 0.0],
+    ], dtype=np.float32))
+
+    idx, scores = run_csr_topk(matrix, 5)
+
+    assert idx.shape == scores.shape == (2, 3)
+    np.testing.assert_array_equal(idx, [[1, 0, 2], [0, 1, 2]])
+    assert (idx >= 0).all()